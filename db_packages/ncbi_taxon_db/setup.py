@@ -12,7 +12,7 @@ from setuptools import setup, find_packages
 
 setup(
     name="ncbi-taxon-db",
-    version="2023.11.4",
+    version="2023.11.4.post1",
     install_requires=[
         "ncbi-refseq-accession-db == 2023.11.4",
         "ncbi-refseq-accession-lengths == 2023.11.4",
@@ -1,6 +1,11 @@
+import functools
+import mmap
 import os
+import struct
+import threading
+import weakref
 from enum import Enum
-from typing import List, Union
+from typing import Iterable, List, Union
 
 import ncbi_taxon_db
 import urllib3
@@ -19,9 +24,9 @@ try:
 except ImportError:
     import ncbi_refseq_accession_offsets as accession_offsets
 
-from marisa_trie import RecordTrie
+from marisa_trie import RecordTrie, Trie
 
-from .util import NcbiNa2Decoder
+from .util import NcbiNa2Decoder, ZstdFrameIndex
 from .version import __version__  # noqa
 
 Rank = Enum(
@@ -33,6 +38,8 @@ Rank = Enum(
         "subvariety superclass superfamily superkingdom superorder superphylum tribe varietas no_rank"
     ),
 )
+# Rank members indexed by value - 1, to look up ranks stored in the taxa index without going through EnumMeta.__call__
+_ranks_by_value = tuple(Rank)
 
 
 BLASTDatabase = Enum(
@@ -48,21 +55,48 @@ class NoValue(TaxoniqException):
     pass
 
 
+# BLAST databases whose volume file names use two-digit volume IDs
+_short_volume_id_blast_dbs = frozenset({"ref_prok_rep_genomes", "Betacoronavirus"})
+
+
 class DatabaseService:
+    __slots__ = ()
     _databases = {}
+    _databases_lock = threading.Lock()
+
+    # Maps database names to (db_type, filename), where db_type is the zstandard module for framed string blobs,
+    # the mmap module for raw arrays, Trie for key-only tries, or a RecordTrie record format. Databases are only
+    # constructed and mmap'd on first access.
+    _db_files = {}
+
+    @classmethod
+    def _get_db(cls, db_name):
+        db = cls._databases.get(db_name)
+        if db is None:
+            db = cls._load_db(db_name)
+        return db
 
-    def _get_db(self, db_name):
-        if db_name not in self._databases:
-            db_type, filename = self._db_files[db_name]
-            if db_type == zstandard:
-                with open(filename, "rb") as fh:
-                    self._databases[db_name] = zstandard.decompress(fh.read())
-            else:
-                self._databases[db_name] = db_type.mmap(filename)
-        return self._databases[db_name]
+    @classmethod
+    def _load_db(cls, db_name):
+        # Concurrent first accesses (e.g. from the CLI's thread pool) would otherwise each load the same database
+        with cls._databases_lock:
+            if db_name not in cls._databases:
+                db_type, filename = cls._db_files[db_name]
+                if db_type == zstandard:
+                    cls._databases[db_name] = ZstdFrameIndex(filename)
+                elif db_type == mmap:
+                    with open(filename, "rb") as fh:
+                        cls._databases[db_name] = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+                elif db_type == Trie:
+                    cls._databases[db_name] = Trie().mmap(filename)
+                else:
+                    cls._databases[db_name] = RecordTrie(db_type).mmap(filename)
+            return cls._databases[db_name]
 
 
 class ItemAttrAccess:
+    __slots__ = ()
+
     def __getitem__(self, item):
         return getattr(self, item)
 
@@ -73,73 +107,60 @@ class Accession(DatabaseService, ItemAttrAccess):
     This is used by Taxoniq to represent sequences associated with taxons; use :class:`Taxon` as the starting point.
     """
 
+    # Database-backed attributes are plain slots that __getattr__ fills on first access; dict values are docstrings
+    __slots__ = {
+        "accession_id": None,
+        "_packed_id": None,
+        "tax_id": "The taxon ID associated with this sequence accession ID.",
+        "blast_db": "The BLAST database in which this sequence accession ID was indexed.",
+        "blast_db_volume": "The numeric BLAST database volume ID in which this sequence accession was indexed.",
+        "length": "The length of the sequence (number of nucleotides or amino acids).",
+        "db_offset": "The byte offset in the BLAST database volume at which this sequence starts.",
+    }
     _db_files = {
-        "accessions": (RecordTrie("IH"), accession_db.db),
-        "accession_offsets": (RecordTrie("I"), accession_offsets.db),
-        "accession_lengths": (RecordTrie("I"), accession_lengths.db),
+        "accessions": ("IH", accession_db.db),
+        "accession_offsets": ("I", accession_offsets.db),
+        "accession_lengths": ("I", accession_lengths.db),
     }
-    http = urllib3.PoolManager(maxsize=min(32, os.cpu_count() + 4))
+    # S3 throttles with 503 SlowDown, so retry server errors with backoff before surfacing them
+    http = urllib3.PoolManager(
+        maxsize=min(32, os.cpu_count() + 4),
+        retries=urllib3.Retry(3, backoff_factor=0.2, status_forcelist=(500, 502, 503, 504), raise_on_status=False),
+    )
     s3_host = "ncbi-blast-databases.s3.amazonaws.com"
 
     def __init__(self, accession_id: str):
         self.accession_id = accession_id
         self._packed_id = self._pack_id(accession_id)
-        self._tax_id = None
-        self._blast_db, self._blast_db_volume, self._db_offset, self._length = None, None, None, None
-
-    def _load_accession_data(self):
-        self._tax_id, db_info = self._get_db("accessions")[self._packed_id][0]
-        self._blast_db = BLASTDatabase(db_info >> 8)
-        self._blast_db_volume = db_info & 0xFF
-
-    @property
-    def tax_id(self):
-        """
-        The taxon ID associated with this sequence accession ID.
-        """
-        if self._tax_id is None:
-            self._load_accession_data()
-        return self._tax_id
-
-    @property
-    def blast_db(self):
-        """
-        The BLAST database in which this sequence accession ID was indexed.
-        """
-        if self._blast_db is None:
-            self._load_accession_data()
-        return self._blast_db
-
-    @property
-    def blast_db_volume(self):
-        """
-        The numeric BLAST database volume ID in which this sequence accession was indexed.
-        """
-        if self._blast_db_volume is None:
-            self._load_accession_data()
-        return self._blast_db_volume
 
-    @property
-    def length(self):
-        """
-        The length of the sequence (number of nucleotides or amino acids).
-        """
-        if self._length is None:
-            self._length = self._get_db("accession_lengths")[self._packed_id][0][0]
-        return self._length
+    def __getattr__(self, name):
+        # Only called for unset slots (and unknown names); once loaded, attributes are read directly from their slots
+        if name in {"tax_id", "blast_db", "blast_db_volume"}:
+            self.tax_id, db_info = self._get_db("accessions")[self._packed_id][0]
+            self.blast_db = BLASTDatabase(db_info >> 8)
+            self.blast_db_volume = db_info & 0xFF
+        elif name == "length":
+            self.length = self._get_db("accession_lengths")[self._packed_id][0][0]
+        elif name == "db_offset":
+            self.db_offset = self._get_db("accession_offsets")[self._packed_id][0][0]
+        else:
+            raise AttributeError(f"{type(self).__name__!r} object has no attribute {name!r}")
+        return getattr(self, name)
 
-    @property
-    def db_offset(self):
+    @classmethod
+    def batch_tax_ids(cls, accession_ids: Iterable[str]) -> List[int]:
         """
-        The byte offset in the BLAST database volume at which this sequence starts.
+        Returns the taxon IDs associated with a sequence of accession IDs, in the same order. Equivalent to
+        `[Accession(i).tax_id for i in accession_ids]`, but without constructing an Accession object for each ID.
         """
-        if self._db_offset is None:
-            self._db_offset = self._get_db("accession_offsets")[self._packed_id][0][0]
-        return self._db_offset
+        accessions_db, pack_id = cls._get_db("accessions"), cls._pack_id
+        return [accessions_db[pack_id(accession_id)][0][0] for accession_id in accession_ids]
 
-    def _pack_id(self, accession_id):
+    @staticmethod
+    def _pack_id(accession_id):
         if accession_id.endswith(".1"):
-            accession_id = accession_id[: -len(".1")]
+            # str.removesuffix is not available on Python 3.8
+            accession_id = accession_id[:-2]
         accession_id = accession_id.replace("_", "")
         return accession_id
 
@@ -148,16 +169,14 @@ class Accession(DatabaseService, ItemAttrAccess):
         Returns a file-like object streaming the nucleotide sequence for this accession from the AWS S3 NCBI BLAST
         database mirror (https://registry.opendata.aws/ncbi-blast-databases/), if available.
         """
-        # FIXME: rjust value has to be 3 for some databases
-        volume_id_length = 2 if self.blast_db.name in {"ref_prok_rep_genomes", "Betacoronavirus"} else 3
-        blast_db = f"{self.blast_db.name}.{str(self.blast_db_volume).rjust(3, '0')}"
-        if self.blast_db.name == "ref_viruses_rep_genomes":
-            blast_db = f"{self.blast_db.name}"
-        else:
-            volume_id_length = 2 if self.blast_db.name in {"ref_prok_rep_genomes", "Betacoronavirus"} else 3
-            blast_db = f"{self.blast_db.name}.{str(self.blast_db_volume).rjust(volume_id_length, '0')}"
+        blast_db = self.blast_db.name
+        if blast_db != "ref_viruses_rep_genomes":
+            volume_id_length = 2 if blast_db in _short_volume_id_blast_dbs else 3
+            blast_db = f"{blast_db}.{self.blast_db_volume:0{volume_id_length}d}"
         s3_url = f"https://{self.s3_host}/{accession_db.db_timestamp}/{blast_db}.nsq"
-        headers = {"Range": f"bytes={self.db_offset}-{self.db_offset + (self.length // 4)}"}
+        # Sequences are packed 4 bases per byte; request exactly the bytes covering self.length bases (the range end is
+        # inclusive)
+        headers = {"Range": f"bytes={self.db_offset}-{self.db_offset + (self.length + 3) // 4 - 1}"}
         res = self.http.request("GET", s3_url, headers=headers, preload_content=False)
         if res.status // 100 != 2:
             raise TaxoniqException(f"Error while retrieving {s3_url}: {res.status} {res.reason}")
@@ -178,10 +197,19 @@ class Accession(DatabaseService, ItemAttrAccess):
         return f"https://www.ncbi.nlm.nih.gov/nuccore/{self.accession_id}"
 
     def __eq__(self, other):
+        if not isinstance(other, Accession):
+            return NotImplemented
         return self.accession_id == other.accession_id
 
+    def __hash__(self):
+        return hash(self.accession_id)
+
+    def __reduce__(self):
+        # The default reduction of a slotted object reads every slot, which would load the unset ones from the databases
+        return type(self), (self.accession_id,)
+
     def __repr__(self):
-        return "{}.{}('{}')".format(self.__module__, self.__class__.__name__, self.accession_id)
+        return f"{self.__module__}.{type(self).__name__}('{self.accession_id}')"
 
 
 class Taxon(DatabaseService, ItemAttrAccess):
@@ -189,14 +217,26 @@ class Taxon(DatabaseService, ItemAttrAccess):
     An object representing an NCBI Taxonomy taxon, identified by its taxon ID. The object can be instantiated by
     uniquely identifying a taxon using the numeric taxon ID, an alphanumeric accession ID of a sequence associated with
     the taxon ID, or the scientific name of the taxon.
+
+    Taxon objects are cached by taxon ID: while a taxon is in use, instantiating it again returns the same object.
     """
 
     # TODO: more attributes from structured metadata at species/strain level e.g. gc, ploidy, ...
+    __slots__ = (
+        "tax_id",
+        "_key",
+        "_parent",
+        "_rank_id",
+        "division_id",
+        "specified_species",
+        "__weakref__",
+    )
     _db_dir = ncbi_taxon_db.db_dir
     _db_files = {
-        "taxa": (RecordTrie("IBBB"), os.path.join(_db_dir, "taxa.marisa")),
-        "wikidata": (RecordTrie("I"), os.path.join(_db_dir, "wikidata.marisa")),
-        "sn2t": (RecordTrie("I"), os.path.join(_db_dir, "sn2taxid.marisa")),
+        "taxa": ("IH", os.path.join(_db_dir, "taxa.marisa")),
+        "wikidata": ("I", os.path.join(_db_dir, "wikidata.marisa")),
+        "sn2t": (Trie, os.path.join(_db_dir, "sn2taxid.marisa")),
+        "sn2t_tax_ids": (mmap, os.path.join(_db_dir, "sn2taxid.u32")),
     }
     _string_index_names = (
         "scientific_name",
@@ -208,44 +248,102 @@ class Taxon(DatabaseService, ItemAttrAccess):
         "child_nodes",
         "host",
     )
-    for _string_index in _string_index_names:
-        _db_files[_string_index] = (zstandard, os.path.join(_db_dir, _string_index + ".zstd"))
-        _db_files[_string_index + "_pos"] = (RecordTrie("I"), os.path.join(_db_dir, _string_index + ".marisa"))
+    # Class scope is not visible inside comprehensions, hence ncbi_taxon_db.db_dir in place of _db_dir
+    _db_files.update(
+        {name: (zstandard, os.path.join(ncbi_taxon_db.db_dir, name + ".zstd")) for name in _string_index_names}
+    )
+    _db_files.update(
+        {name + "_pos": ("II", os.path.join(ncbi_taxon_db.db_dir, name + ".marisa")) for name in _string_index_names}
+    )
 
-    common_ranks = {
-        Rank[i] for i in ("species", "genus", "family", "order", "class", "phylum", "kingdom", "superkingdom")
-    }
+    common_ranks = frozenset(
+        (
+            Rank.species,
+            Rank.genus,
+            Rank.family,
+            Rank.order,
+            Rank["class"],
+            Rank.phylum,
+            Rank.kingdom,
+            Rank.superkingdom,
+        )
+    )
+    # Rank values of common_ranks, so lineage filters can test the raw rank stored in taxa records
+    _common_rank_ids = frozenset(rank.value for rank in common_ranks)
+
+    # Live Taxon objects by tax_id, so repeated construction of the same taxon returns the same object
+    _instances = weakref.WeakValueDictionary()
 
-    def __init__(self, tax_id: int = None, accession_id: str = None, scientific_name: str = None):
+    def __new__(cls, tax_id: int = None, accession_id: str = None, scientific_name: str = None):
         if sum(x is not None for x in (tax_id, accession_id, scientific_name)) != 1:
             raise TaxoniqException("Expected exactly one of tax_id, accession_id, or scientific_name to be set")
         if tax_id is not None:
-            self.tax_id = int(tax_id)
+            tax_id = int(tax_id)
         elif accession_id is not None:
-            self.tax_id = Accession(accession_id).tax_id
+            tax_id = Accession(accession_id).tax_id
         elif scientific_name is not None:
-            self.tax_id = self._get_db("sn2t")[scientific_name][0][0]
-        self._parent, rank, self.division_id, self.specified_species = self._get_db("taxa")[str(self.tax_id)][0]
-        self._rank = Rank(rank)
-        self._str_attr_cache = {}
+            key_id = cls._get_db("sn2t")[scientific_name]
+            tax_id = struct.unpack_from("<I", cls._get_db("sn2t_tax_ids"), 4 * key_id)[0]
+        return cls._from_tax_id(tax_id)
+
+    @classmethod
+    def _from_tax_id(cls, tax_id, taxa_record=None, key=None):
+        taxon = cls._instances.get(tax_id)
+        if taxon is None:
+            taxon = super().__new__(cls)
+            taxon.tax_id, taxon._key = tax_id, str(tax_id) if key is None else key
+            if taxa_record is None:
+                taxa_record = cls._get_db("taxa")[taxon._key][0]
+            taxon._load_taxa_record(taxa_record)
+            cls._instances[tax_id] = taxon
+        return taxon
+
+    def _load_taxa_record(self, record):
+        # The flags field packs the rank (bits 0-7), division ID (bits 8-14) and specified species flag (bit 15)
+        self._parent, flags = record
+        self._rank_id, self.division_id, self.specified_species = flags & 0xFF, (flags >> 8) & 0x7F, flags >> 15
+
+    @classmethod
+    def _from_keys(cls, keys):
+        """
+        Returns taxa for an iterable of decimal taxon ID strings, reusing each string as the taxa trie key.
+        """
+        from_tax_id = cls._from_tax_id
+        return [from_tax_id(int(key), key=key) for key in keys]
+
+    def _iter_ancestor_records(self):
+        """
+        Yields (tax_id, taxa record) for each ancestor of this taxon up to the root, without constructing Taxon objects.
+        """
+        taxa_db = self._get_db("taxa")
+        tax_id, parent = self.tax_id, self._parent
+        while tax_id != 1:
+            tax_id = parent
+            taxa_record = taxa_db[str(tax_id)][0]
+            yield tax_id, taxa_record
+            parent = taxa_record[0]
 
     def _get_str_attr(self, attr_name):
-        if attr_name not in self._str_attr_cache:
-            pos_db = self._get_db(attr_name + "_pos")
-            str_db = self._get_db(attr_name)
-            try:
-                pos = pos_db[str(self.tax_id)][0][0]
-            except KeyError:
-                raise NoValue(f'The taxon {self} has no value indexed for "{attr_name}"')
-            self._str_attr_cache[attr_name] = str_db[pos : str_db.index(b"\n", pos)].decode()
-        return self._str_attr_cache[attr_name]
+        try:
+            return self._read_str(attr_name, self._key)
+        except KeyError:
+            raise NoValue(f'The taxon {self} has no value indexed for "{attr_name}"')
+
+    # Decoded strings are cached per class rather than per instance, so they outlive the (weakly memoized) taxa that
+    # read them
+    @classmethod
+    @functools.lru_cache(maxsize=65536)
+    def _read_str(cls, attr_name, key):
+        pos, length = cls._get_db(attr_name + "_pos")[key][0]
+        # Decode straight out of the decompressed frame to avoid copying the record into a new bytes object
+        return str(cls._get_db(attr_name).get_record(pos, length), "utf-8")
 
     @property
     def rank(self) -> Rank:
         """
         Rank of the taxon. See https://www.ncbi.nlm.nih.gov/pmc/articles/PMC7408187/#sec9title for more details.
         """
-        return self._rank
+        return _ranks_by_value[self._rank_id - 1]
 
     @property
     def scientific_name(self) -> str:
@@ -269,8 +367,7 @@ class Taxon(DatabaseService, ItemAttrAccess):
         Lineage for this taxon (the list of parent nodes from the taxon to the root of the taxonomic tree).
         """
         lineage = [self]
-        while lineage[-1].tax_id != 1:
-            lineage.append(Taxon(lineage[-1]._parent))
+        lineage.extend(self._from_tax_id(tax_id, taxa_record) for tax_id, taxa_record in self._iter_ancestor_records())
         return lineage
 
     @property
@@ -278,7 +375,11 @@ class Taxon(DatabaseService, ItemAttrAccess):
         """
         Lineage of main taxonomic ranks (species, genus, family, order, class, phylum, kingdom, superkingdom).
         """
-        return list(filter(lambda t: t.rank in self.common_ranks, self.lineage))
+        lineage = [self] if self._rank_id in self._common_rank_ids else []
+        for tax_id, taxa_record in self._iter_ancestor_records():
+            if (taxa_record[1] & 0xFF) in self._common_rank_ids:
+                lineage.append(self._from_tax_id(tax_id, taxa_record))
+        return lineage
 
     @property
     def parent(self) -> "Union[Taxon, None]":
@@ -290,14 +391,14 @@ class Taxon(DatabaseService, ItemAttrAccess):
         if self.tax_id == 0:
             return None
         else:
-            return Taxon(self._parent)
+            return self._from_tax_id(self._parent)
 
     @property
     def child_nodes(self) -> "List[Taxon]":
         """
         Returns a list of taxon objects that list this taxon as their parent.
         """
-        return [Taxon(int(t)) for t in self._get_str_attr("child_nodes").split(",")]
+        return self._from_keys(self._get_str_attr("child_nodes").split(","))
 
     @property
     def ranked_child_nodes(self) -> "List[Taxon]":
@@ -305,7 +406,7 @@ class Taxon(DatabaseService, ItemAttrAccess):
         List of child nodes in the next main taxonomic rank (species, genus, family, order, class, phylum, kingdom,
         superkingdom).
         """
-        return list(filter(lambda t: t.rank in self.common_ranks, self.child_nodes))
+        return list(filter(lambda t: t._rank_id in self._common_rank_ids, self.child_nodes))
 
     @property
     def description(self) -> str:
@@ -314,7 +415,7 @@ class Taxon(DatabaseService, ItemAttrAccess):
         """
         try:
             return self._get_str_attr("description")
-        except KeyError:
+        except NoValue:
             return ""
 
     @property
@@ -323,11 +424,20 @@ class Taxon(DatabaseService, ItemAttrAccess):
         Introductory paragraph from English Wikipedia for this taxon or the first parent taxon where a description is
         available.
         """
-        t = self
-        while t.tax_id != 1:
-            if t.description:
-                return t.description
-            t = t.parent
+        if self.tax_id == 1:
+            return ""
+        if self.description:
+            return self.description
+        # Look up ancestors' descriptions by key instead of constructing a Taxon for each of them
+        for tax_id, _ in self._iter_ancestor_records():
+            if tax_id == 1:
+                break
+            try:
+                description = self._read_str("description", str(tax_id))
+            except KeyError:
+                continue
+            if description:
+                return description
         return ""
 
     @property
@@ -401,7 +511,7 @@ class Taxon(DatabaseService, ItemAttrAccess):
         """
         Wikidata ID for this taxon.
         """
-        wikidata_id = self._get_db("wikidata")[str(self.tax_id)][0][0]
+        wikidata_id = self._get_db("wikidata")[self._key][0][0]
         return f"Q{wikidata_id}"
 
     @property
@@ -413,7 +523,15 @@ class Taxon(DatabaseService, ItemAttrAccess):
             return f"https://www.wikidata.org/wiki/{self.wikidata_id}"
 
     def __eq__(self, other):
+        if not isinstance(other, Taxon):
+            return NotImplemented
         return self.tax_id == other.tax_id
 
+    def __hash__(self):
+        return hash(self.tax_id)
+
+    def __reduce__(self):
+        return type(self), (self.tax_id,)
+
     def __repr__(self):
-        return "{}.{}({})".format(self.__module__, self.__class__.__name__, self.tax_id)
+        return f"{self.__module__}.{type(self).__name__}({self.tax_id})"
@@ -1,3 +1,4 @@
+import array
 import io
 import json
 import logging
@@ -7,22 +8,64 @@ import struct
 import subprocess
 import sys
 import warnings
-from collections import defaultdict
+from collections import defaultdict, deque
 from concurrent.futures import ThreadPoolExecutor
-from hashlib import sha256
 
 import urllib3
 import zstandard
 
-from . import Accession, BLASTDatabase, RecordTrie
+# orjson is optional; it speeds up parsing Wikidata API responses and the build caches
+try:
+    from orjson import dumps as json_dumps
+    from orjson import loads as json_loads
+except ImportError:
+
+    def json_dumps(obj):
+        return json.dumps(obj).encode()
+
+    json_loads = json.loads
+
+from . import Accession, BLASTDatabase, RecordTrie, Trie, __version__
 from .tax_dump_readers import HostReader, NodesReader, TaxonomyNamesReader
 
 logger = logging.getLogger(__name__)
 
-http = urllib3.PoolManager(maxsize=min(64, os.cpu_count() + 8))
+# Most build downloads are small and latency-bound, so download concurrency is sized to the connection pool rather
+# than to the number of CPUs
+max_http_workers = 64
+
+# Requests go to a handful of hosts (Wikipedia, Wikidata, NCBI FTP); reuse connections, accept compressed responses
+# (urllib3 decodes them transparently), and retry throttling and server errors with backoff
+http = urllib3.PoolManager(
+    maxsize=max_http_workers,
+    headers=urllib3.make_headers(accept_encoding=True, user_agent=f"taxoniq-build/{__version__}"),
+    retries=urllib3.Retry(5, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504), raise_on_status=False),
+)
 
 db_packages_dir = os.path.join(os.path.dirname(__file__), "..", "db_packages")
 
+# Empty paragraphs and everything from the first HTML comment on are stripped from Wikipedia extracts
+extract_cleanup_pattern = re.compile(r'<p class="mw-empty-elt">.+?</p>|\s*<!--.+', flags=re.DOTALL)
+
+# Uncompressed size after which write_taxid_to_string_index starts a new zstd frame
+string_db_frame_size = 64 * 1024
+# String indexes are built once and read many times, so they are compressed at a high level with one reused context
+string_db_compressor = zstandard.ZstdCompressor(level=19)
+
+
+def bounded_map(executor, fn, iterable, max_pending):
+    """
+    Like executor.map, but consumes iterable lazily and keeps at most max_pending calls in flight, so neither the
+    inputs nor the finished results pile up in memory. Results are yielded in input order.
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
 
 class WikipediaDescriptionClient:
     def get_taxonbar_page_ids(self):
@@ -36,7 +79,7 @@ class WikipediaDescriptionClient:
         while True:
             res = http.request("GET", url="https://en.wikipedia.org/w/api.php", fields=params)
             assert res.status == 200
-            page = json.loads(res.data)
+            page = json_loads(res.data)
             for pageset_start in range(0, len(page["query"]["embeddedin"]), 50):
                 yield [
                     str(record["pageid"]) for record in page["query"]["embeddedin"][pageset_start : pageset_start + 50]
@@ -49,7 +92,7 @@ class WikipediaDescriptionClient:
         params = dict(action="query", prop="revisions", rvprop="content", format="json", **kwargs)
         res = http.request("GET", url=f"https://{domain}/w/api.php", fields=params)
         assert res.status == 200, res
-        res_doc = json.loads(res.data)
+        res_doc = json_loads(res.data)
         for page in res_doc["query"]["pages"].values():
             assert page["ns"] == 0
             assert len(page["revisions"]) == 1
@@ -69,7 +112,7 @@ class WikipediaDescriptionClient:
         while True:
             res = http.request("GET", url="https://www.wikidata.org/w/api.php", fields=params)
             assert res.status == 200, res
-            res_doc = json.loads(res.data)
+            res_doc = json_loads(res.data)
             for page_links in res_doc["query"]["pages"].values():
                 for pageset_start in range(0, len(page_links["linkshere"]), 50):
                     yield [
@@ -92,16 +135,10 @@ class WikipediaDescriptionClient:
         )
         res = http.request("GET", url=f"https://{domain}/w/api.php", fields=params)
         assert res.status == 200, res
-        res_doc = json.loads(res.data)
+        res_doc = json_loads(res.data)
         for page in res_doc["query"]["pages"].values():
             if page["ns"] == 0 and "extract" in page and "title" in page:
-                page["extract"] = re.sub(
-                    r'<p class="mw-empty-elt">.+?</p>',
-                    "",
-                    page["extract"],
-                    flags=re.DOTALL,
-                )
-                page["extract"] = re.sub(r"\s*<!--.+", "", page["extract"], flags=re.DOTALL)
+                page["extract"] = extract_cleanup_pattern.sub("", page["extract"])
                 yield page
             else:
                 logger.error("Error retrieving extract: %s", page)
@@ -109,7 +146,10 @@ class WikipediaDescriptionClient:
     def process_pageid_set(self, pageid_set):
         tax_data_by_title = {}
         for pageid, title, page in self.get_wiki_pages(pageids="|".join(pageid_set)):
-            page = json.loads(page)
+            # Skip parsing (large) entity documents that cannot have an enwiki sitelink and an NCBI taxid claim
+            if '"enwiki"' not in page or '"P685"' not in page:
+                continue
+            page = json_loads(page)
             if "redirect" in page or "enwiki" not in page.get("sitelinks", {}):
                 continue
             en_wiki_title = page["sitelinks"]["enwiki"]["title"]
@@ -131,17 +171,26 @@ class WikipediaDescriptionClient:
         logger.debug("Processed %d pages", len(tax_data_by_title))
         return tax_data_by_title
 
+    def process_pageid_sets(self, pageid_sets, executor, max_pending):
+        """
+        Yields the results of process_pageid_set for each page ID set, in order, with at most max_pending sets in
+        flight, so link pagination overlaps with page processing and stops as soon as the caller stops iterating.
+        """
+        return bounded_map(executor, self.process_pageid_set, pageid_sets, max_pending)
+
     def build_index(self, destdir, max_records=sys.maxsize, **threadpool_kwargs):
         index_filename = os.path.join(destdir, "wikipedia_extracts.json")
-        with open(index_filename, "w") as fh, ThreadPoolExecutor(**threadpool_kwargs) as executor:
+        max_workers = threadpool_kwargs.setdefault("max_workers", min(32, os.cpu_count() + 4))
+        with open(index_filename, "wb") as fh, ThreadPoolExecutor(**threadpool_kwargs) as executor:
             n_records = 0
             # Q16521, taxon
-            for tax_data_set in executor.map(
-                self.process_pageid_set,
+            for tax_data_set in self.process_pageid_sets(
                 self.get_wikidata_linkshere("Q16521", max_pages=max_records),
+                executor=executor,
+                max_pending=2 * max_workers,
             ):
                 for tax_datum in tax_data_set.values():
-                    fh.write(json.dumps(tax_datum) + "\n")
+                    fh.write(json_dumps(tax_datum) + b"\n")
                     n_records += 1
                 logger.debug("Wrote %d records", n_records)
                 if n_records >= max_records:
@@ -163,37 +212,50 @@ def field_spec(field):
     return spec
 
 
-def load_taxa():
+def load_taxa(taxid2childnodes=None):
+    """
+    Yields (tax_id, (parent, flags)) records for the taxa index. The rank, division ID and specified species flag are
+    packed into the 16-bit flags field as bits 0-7, 8-14 and 15 respectively (see taxoniq.Taxon._load_taxa_record).
+
+    If taxid2childnodes (a defaultdict(list)) is given, the IDs of each taxon's child nodes are collected into it, keyed
+    by the parent's ID, in the same pass.
+    """
     rows_processed = 0
-    for row in NodesReader():
+    for tax_id, parent, rank, division_id, specified_species in NodesReader(
+        columns=("tax_id", "parent", "rank", "division_id", "specified_species")
+    ):
+        assert rank < 1 << 8 and division_id < 1 << 7 and specified_species < 1 << 1
+        tax_id = str(tax_id)
+        if taxid2childnodes is not None and tax_id != "1":
+            taxid2childnodes[str(parent)].append(tax_id)
         yield (
-            str(row["tax_id"]),
-            (row["parent"], row["rank"], row["division_id"], row["specified_species"]),
+            tax_id,
+            (parent, rank | division_id << 8 | specified_species << 15),
         )
         rows_processed += 1
         if rows_processed % 100000 == 0:
             logger.info("Processed %d taxon rows", rows_processed)
 
 
-def load_child_nodes():
-    taxid2childnodes = defaultdict(list)
-    for tax_id, tax_data in load_taxa():
-        if tax_id != "1":
-            taxid2childnodes[tax_data[0]].append(tax_id)
-    for tax_id, child_nodes in taxid2childnodes.items():
-        yield tax_id, ",".join(child_nodes)
+def get_taxonomy_dfs_order(taxid2childnodes):
+    """
+    Returns a dict mapping taxon IDs (as strings) to their position in a depth-first traversal of the taxonomy tree.
+    """
+    dfs_order, stack = {}, ["1"]
+    while stack:
+        tax_id = stack.pop()
+        dfs_order[tax_id] = len(dfs_order)
+        stack.extend(reversed(taxid2childnodes.get(tax_id, ())))
+    return dfs_order
 
 
 def load_common_names(names):
-    for tax_id, tax_names in names.items():
-        if "blast name" in tax_names:
-            yield (tax_id, tax_names["blast name"])
-        elif "genbank common name" in tax_names:
-            yield (tax_id, tax_names["genbank common name"])
-        elif "common name" in tax_names:
-            yield (tax_id, tax_names["common name"])
-        else:
-            pass  # FIXME: fall back to en_wiki_title
+    # Blast names take precedence over GenBank common names, which take precedence over other common names
+    # FIXME: fall back to en_wiki_title
+    common_names = dict(names["common name"])
+    common_names.update(names["genbank common name"])
+    common_names.update(names["blast name"])
+    return common_names.items()
 
 
 def preprocess_accession_data(blast_db_names, taxid2refrep):
@@ -201,7 +263,7 @@ def preprocess_accession_data(blast_db_names, taxid2refrep):
     processed_accessions = 0
     for blast_db_name in blast_db_names:
         for accession_id, accession_info in load_accession_info_from_blast_db(blast_db_name):
-            accession_info["packed_id"] = Accession._pack_id(Accession, accession_id)
+            accession_info["packed_id"] = Accession._pack_id(accession_id)
             if accession_id in all_accessions:
                 duplicate_accessions.add(accession_id)
                 continue
@@ -219,43 +281,111 @@ def preprocess_accession_data(blast_db_names, taxid2refrep):
     logger.info("%d duplicate accessions skipped", len(duplicate_accessions))
 
 
-def write_taxid_to_string_index(mapping, index_name, destdir):
+def write_string_db_frame(fh, string_db, frame_start, frame_index):
+    frame_index.extend((frame_start, fh.tell()))
+    fh.write(string_db_compressor.compress(string_db.getbuffer()))
+    return frame_start + string_db.tell()
+
+
+def write_taxid_to_string_index(mapping, index_name, destdir, taxon_order=None):
+    """
+    Writes strings back to back as a sequence of independent zstd frames, each holding whole records and starting a new
+    frame once string_db_frame_size uncompressed bytes are reached. The .zsti sidecar lists the uncompressed and
+    compressed start offset of each frame as little-endian uint64 pairs, so readers only decompress the frame they need.
+    The .marisa trie maps each taxon ID to the (offset, length) of its record.
+
+    If taxon_order (see get_taxonomy_dfs_order) is given, records are written in that order, so the records of a taxon
+    and its close relatives share frames and a lineage walk decompresses few of them.
+    """
     logger.info("Writing string index %s to %s...", index_name, destdir)
-    taxid2pos, str2pos = {}, {}
-    string_db = io.BytesIO()
-    for tax_id, string_value in mapping:
-        string_value_csum = sha256(string_value.encode()).digest()
-        if string_value_csum in str2pos:
-            taxid2pos[tax_id] = str2pos[string_value_csum]
-        else:
-            taxid2pos[tax_id] = string_db.tell()
-            string_db.write(string_value.replace("\n", " ").encode())
-            string_db.write(b"\n")
-            str2pos[string_value_csum] = taxid2pos[tax_id]
+    # Taxon IDs are converted to trie keys once, up front
+    mapping = ((str(tax_id), string_value) for tax_id, string_value in mapping)
+    if taxon_order is not None:
+        mapping = sorted(mapping, key=lambda i: taxon_order.get(i[0], len(taxon_order)))
+    taxid2pos, str2pos, frame_index = {}, {}, []
+    string_db, frame_start = io.BytesIO(), 0
     with open(os.path.join(destdir, f"{index_name}.zstd"), "wb") as fh:
-        fh.write(zstandard.compress(string_db.getvalue()))
-
-    t = RecordTrie("I", [(str(tid), (pos,)) for tid, pos in taxid2pos.items()])
+        # Strings are deduplicated on their own value; when taxon_order is given, they are all in memory anyway
+        for tax_id, string_value in mapping:
+            if string_value in str2pos:
+                taxid2pos[tax_id] = str2pos[string_value]
+            else:
+                if string_db.tell() >= string_db_frame_size:
+                    frame_start = write_string_db_frame(fh, string_db, frame_start, frame_index)
+                    string_db = io.BytesIO()
+                record = string_value.replace("\n", " ").encode()
+                taxid2pos[tax_id] = (frame_start + string_db.tell(), len(record))
+                string_db.write(record)
+                str2pos[string_value] = taxid2pos[tax_id]
+        write_string_db_frame(fh, string_db, frame_start, frame_index)
+    with open(os.path.join(destdir, f"{index_name}.zsti"), "wb") as fh:
+        fh.write(struct.pack(f"<{len(frame_index)}Q", *frame_index))
+
+    t = RecordTrie("II", taxid2pos.items())
     t.save(os.path.join(destdir, f"{index_name}.marisa"))
     logger.info("Completed writing string index %s to %s", index_name, destdir)
 
 
-def fetch_file(url):
+def write_name_to_taxid_index(sn2taxid, destdir):
+    # The key IDs of a plain Trie index a parallel array of little-endian uint32 taxon IDs, so the trie stores no
+    # record payload
+    t = Trie(sn2taxid.keys())
+    tax_ids = [0] * len(t)
+    for scientific_name, tax_id in sn2taxid.items():
+        tax_ids[t[scientific_name]] = tax_id
+    t.save(os.path.join(destdir, "sn2taxid.marisa"))
+    with open(os.path.join(destdir, "sn2taxid.u32"), "wb") as fh:
+        fh.write(struct.pack(f"<{len(tax_ids)}I", *tax_ids))
+
+
+def fetch_file(url, revalidate=False):
+    """
+    Downloads url into the build download cache and returns the local filename. Cached downloads are reused as-is,
+    unless revalidate is set (for tables that NCBI updates in place): those are revalidated with a conditional GET
+    against the ETag/Last-Modified validators saved next to them, and only fetched again if changed. If the server sent
+    no validators, no sidecar is saved and the cached download is reused as-is.
+    """
     download_cache = os.path.join(os.environ["BLASTDB"], "downloads")
     os.makedirs(download_cache, exist_ok=True)
     local_filename = os.path.join(download_cache, os.path.basename(url))
-    if not os.path.exists(local_filename):
-        with open(local_filename, "w") as fh:
-            res = http.request("GET", url)
-            assert res.status == 200
-            fh.write(res.data.decode())
+    validators_filename = local_filename + ".validators.json"
+    # Per-request headers replace the pool's default headers, so the conditional headers are added to a copy of them
+    headers = dict(http.headers)
+    if os.path.exists(local_filename):
+        if not revalidate or not os.path.exists(validators_filename):
+            return local_filename
+        with open(validators_filename, "rb") as fh:
+            validators = json_loads(fh.read())
+        if "ETag" in validators:
+            headers["If-None-Match"] = validators["ETag"]
+        if "Last-Modified" in validators:
+            headers["If-Modified-Since"] = validators["Last-Modified"]
+    res = http.request("GET", url, headers=headers, preload_content=False)
+    try:
+        if res.status == 304:
+            return local_filename
+        assert res.status == 200
+        # Stream the body to disk as-is; large files like the RefSeq assembly summary are never held in memory. The
+        # download only replaces the cached file once complete, so an interrupted build never leaves a truncated file
+        with open(local_filename + ".partial", "wb") as fh:
+            for chunk in res.stream(1024 * 1024):
+                fh.write(chunk)
+        os.replace(local_filename + ".partial", local_filename)
+    finally:
+        res.release_conn()
+    validators = {k: res.headers[k] for k in ("ETag", "Last-Modified") if k in res.headers}
+    if revalidate and validators:
+        with open(validators_filename, "wb") as fh:
+            fh.write(json_dumps(validators))
+    elif os.path.exists(validators_filename):
+        os.remove(validators_filename)
     return local_filename
 
 
 def load_wikidata(field="wikidata_id"):
-    with open("wikipedia_extracts.json") as fh:
+    with open("wikipedia_extracts.json", "rb") as fh:
         for line in fh:
-            record = json.loads(line)
+            record = json_loads(line)
             if field in record:
                 yield (
                     record["taxid"],
@@ -264,12 +394,11 @@ def load_wikidata(field="wikidata_id"):
 
 
 def load_hosts():
-    for row in HostReader():
-        yield row["tax_id"], row["potential_hosts"]
+    for tax_id, potential_hosts in HostReader():
+        yield tax_id, potential_hosts
 
 
 def get_virus_genome_data():
-    virus_genome_data = []
     virus_data_url = "https://ftp.ncbi.nlm.nih.gov/genomes/Viruses/Viruses_RefSeq_and_neighbors_genome_data.tab"
     virus_data_fields = (
         "representative",
@@ -279,12 +408,11 @@ def get_virus_genome_data():
         "taxonomy_name",
         "segment_name",
     )
-    with open(fetch_file(virus_data_url)) as fh:
+    with open(fetch_file(virus_data_url, revalidate=True)) as fh:
         for line in fh:
             if line.startswith("#"):
                 continue
-            virus_genome_data.append(dict(zip(virus_data_fields, line.strip().split("\t"))))
-    return virus_genome_data
+            yield dict(zip(virus_data_fields, line.strip().split("\t")))
 
 
 def build_trees(blast_databases=os.environ.get("BLAST_DATABASES", "").split(), destdir=None):
@@ -296,42 +424,44 @@ def build_trees(blast_databases=os.environ.get("BLAST_DATABASES", "").split(), d
     if not blast_databases:
         blast_databases = [db.name for db in BLASTDatabase]
 
+    # nodes.dmp is parsed once: the taxa index is built in the same pass that collects the child nodes of each taxon
+    taxid2childnodes = defaultdict(list)
+    RecordTrie("IH", load_taxa(taxid2childnodes=taxid2childnodes)).save(os.path.join(destdir, "taxa.marisa"))
+    taxon_order = get_taxonomy_dfs_order(taxid2childnodes)
     RecordTrie("I", load_wikidata()).save(os.path.join(destdir, "wikidata.marisa"))
     write_taxid_to_string_index(
         mapping=load_wikidata(field="extract"),
         index_name="description",
         destdir=destdir,
+        taxon_order=taxon_order,
     )
     write_taxid_to_string_index(
         mapping=load_wikidata(field="en_wiki_title"),
         index_name="en_wiki_title",
         destdir=destdir,
+        taxon_order=taxon_order,
     )
-    # TODO: pack all bit fields into one byte
-    RecordTrie("IBBB", load_taxa()).save(os.path.join(destdir, "taxa.marisa"))
-    write_taxid_to_string_index(mapping=load_child_nodes(), index_name="child_nodes", destdir=destdir)
-    write_taxid_to_string_index(mapping=load_hosts(), index_name="host", destdir=destdir)
+    write_taxid_to_string_index(
+        mapping=((tax_id, ",".join(child_nodes)) for tax_id, child_nodes in taxid2childnodes.items()),
+        index_name="child_nodes",
+        destdir=destdir,
+        taxon_order=taxon_order,
+    )
+    write_taxid_to_string_index(mapping=load_hosts(), index_name="host", destdir=destdir, taxon_order=taxon_order)
 
     taxid2refrep = defaultdict(list)
 
-    accession_cache = os.path.join(os.environ["BLASTDB"], "accession_cache")
-    with open(accession_cache, "w") as fh:
-        for acc_info in preprocess_accession_data(blast_databases, taxid2refrep=taxid2refrep):
-            print(json.dumps(acc_info), file=fh)
-
-    def load_accession_data(xform):
-        with open(accession_cache) as fh:
-            for line in fh:
-                yield xform(json.loads(line))
-
-    def acc_xform(acc_info):
-        return (
-            acc_info["packed_id"],
-            (
-                acc_info["tax_id"],
-                ((BLASTDatabase[acc_info["db_name"]].value << 8) + acc_info["volume_id"]),
-            ),
-        )
+    # Accession data is held in parallel arrays (one entry per accession, in the order of packed_ids) so the three
+    # accession tries can be built from memory
+    packed_ids, tax_ids, db_infos = [], array.array("I"), array.array("H")
+    offsets, lengths = array.array("I"), array.array("I")
+    db_info_bases = {db.name: db.value << 8 for db in BLASTDatabase}
+    for acc_info in preprocess_accession_data(blast_databases, taxid2refrep=taxid2refrep):
+        packed_ids.append(acc_info["packed_id"])
+        tax_ids.append(acc_info["tax_id"])
+        db_infos.append(db_info_bases[acc_info["db_name"]] + acc_info["volume_id"])
+        offsets.append(acc_info["offset"])
+        lengths.append(acc_info["length"])
 
     def db_path(db_name, filename="db.marisa"):
         ncbi_db_name = "genbank" if "nt" in blast_databases else "refseq"
@@ -342,49 +472,58 @@ def build_trees(blast_databases=os.environ.get("BLAST_DATABASES", "").split(), d
         with open("latest-dir") as ts, open(db_path(db_name, filename="version.py"), "w") as fh:
             fh.write(f"db_timestamp = '{ts.read().strip()}'")
 
-    t = RecordTrie("IH", load_accession_data(acc_xform))
+    t = RecordTrie("IH", zip(packed_ids, zip(tax_ids, db_infos)))
     t.save(db_path("accession_db"))
     write_index_version("accession_db")
     logger.info("Completed writing %s", db_path("accession_db"))
-    t = RecordTrie("I", load_accession_data(lambda d: (d["packed_id"], (d["offset"],))))
+    t = RecordTrie("I", zip(packed_ids, zip(offsets)))
     t.save(db_path("accession_offsets"))
     write_index_version("accession_offsets")
     logger.info("Completed writing %s", db_path("accession_offsets"))
-    t = RecordTrie("I", load_accession_data(lambda d: (d["packed_id"], (d["length"],))))
+    t = RecordTrie("I", zip(packed_ids, zip(lengths)))
     t.save(db_path("accession_lengths"))
     write_index_version("accession_lengths")
     logger.info("Completed writing %s", db_path("accession_lengths"))
     write_taxid_to_string_index(
-        mapping=[(tid, ",".join(acc)) for tid, acc in taxid2refrep.items()],
+        mapping=((tid, ",".join(acc)) for tid, acc in taxid2refrep.items()),
         index_name="taxid2refrep",
         destdir=destdir,
+        taxon_order=taxon_order,
     )
 
     # FIXME: if we include non-rep refseq accessions, we should index those accessions' positions in nt
     taxid2refseq = index_refseq_accessions(destdir=destdir)
-    write_taxid_to_string_index(mapping=taxid2refseq.items(), index_name="taxid2refseq", destdir=destdir)
+    write_taxid_to_string_index(
+        mapping=taxid2refseq.items(),
+        index_name="taxid2refseq",
+        destdir=destdir,
+        taxon_order=taxon_order,
+    )
 
-    names, sn2taxid = defaultdict(dict), {}
-    for row in TaxonomyNamesReader():
-        if row["tax_id"] in names and row["name_class"] in names[row["tax_id"]]:
+    # Maps each kept name class to a flat dict of taxon ID to name. Rows of other name classes (mostly synonyms) are
+    # dropped before any per-taxon lookup; the first name of each class is kept
+    names = {name_class: {} for name_class in ("scientific name", "common name", "genbank common name", "blast name")}
+    sn2taxid = {}
+    for tax_id, name, name_class in TaxonomyNamesReader(columns=("tax_id", "name", "name_class")):
+        class_names = names.get(name_class)
+        if class_names is None or tax_id in class_names:
             continue
-        if row["name_class"] in {
-            "scientific name",
-            "common name",
-            "genbank common name",
-            "blast name",
-        }:
-            names[row["tax_id"]][row["name_class"]] = row["name"]
-        if row["name_class"] == "scientific name":
-            sn2taxid[row["name"]] = int(row["tax_id"])
-    taxid2name_array = sorted(
-        ((tax_id, row["scientific name"]) for tax_id, row in names.items()),
-        key=lambda i: i[1],
+        class_names[tax_id] = name
+        if name_class == "scientific name":
+            sn2taxid[name] = tax_id
+    write_taxid_to_string_index(
+        mapping=names["scientific name"].items(),
+        index_name="scientific_name",
+        destdir=destdir,
+        taxon_order=taxon_order,
+    )
+    write_name_to_taxid_index(sn2taxid, destdir=destdir)
+    write_taxid_to_string_index(
+        mapping=load_common_names(names),
+        index_name="common_name",
+        destdir=destdir,
+        taxon_order=taxon_order,
     )
-    write_taxid_to_string_index(mapping=taxid2name_array, index_name="scientific_name", destdir=destdir)
-    t = RecordTrie("I", [(sn, (tid,)) for sn, tid in sn2taxid.items()])
-    t.save(os.path.join(destdir, "sn2taxid.marisa"))
-    write_taxid_to_string_index(mapping=load_common_names(names), index_name="common_name", destdir=destdir)
     with open(os.path.join(destdir, "version.py"), "w") as fh:
         fh.write(f"db_timestamp = {int(os.stat('nodes.dmp').st_mtime)}")
 
@@ -404,23 +543,26 @@ def process_assembly_report(assembly_summary):
         "sequence_length",
         "ucsc_style_name",
     )
-    molecules = []
+    # Only the role and GenBank accession of each molecule are used, so rows are indexed directly instead of being
+    # turned into dicts
+    sequence_role = assembly_report_fields.index("sequence_role")
+    genbank_accn = assembly_report_fields.index("genbank_accn")
+    genbank_accns = []
     if ftp_path.startswith("https://ftp.ncbi.nlm.nih.gov"):
         with open(fetch_file(assembly_report_url)) as assembly_report:
             for line in assembly_report:
                 if line.startswith("#"):
                     continue
-                molecule_summary = dict(zip(assembly_report_fields, line.strip().split("\t")))
-                if molecule_summary["sequence_role"] != "assembled-molecule":
+                row = line.strip().split("\t")
+                if row[sequence_role] != "assembled-molecule":
                     continue
-                molecule_summary.update(assembly_summary)
-                molecules.append(molecule_summary)
+                genbank_accns.append(row[genbank_accn])
     else:
         warnings.warn(f"Invalid assembly summary: {assembly_summary}")
-    return molecules
+    return assembly_summary, genbank_accns
 
 
-def index_refseq_accessions(destdir):
+def load_assembly_summaries():
     # See https://www.ncbi.nlm.nih.gov/genome/doc/ftpfaq/#files
     # FIXME: neither genbank nor refseq id represented in nt
     # in assemblies: 6239 6239 Caenorhabditis elegans reference genome
@@ -452,8 +594,7 @@ def index_refseq_accessions(destdir):
         "excluded_from_refseq",
         "relation_to_type_material",
     )
-    assembly_summaries = []
-    with open(fetch_file(assembly_summary_url)) as assembly_summary_fh:
+    with open(fetch_file(assembly_summary_url, revalidate=True)) as assembly_summary_fh:
         for line in assembly_summary_fh:
             if line.startswith("#"):
                 continue
@@ -463,17 +604,25 @@ def index_refseq_accessions(destdir):
             if "FETCH_REFSEQ_ASSEMBLIES" in os.environ:
                 if assembly_summary["organism_name"] not in os.environ["FETCH_REFSEQ_ASSEMBLIES"].split(","):
                     continue
-            assembly_summaries.append(assembly_summary)
+            yield assembly_summary
+
+
+def index_refseq_accessions(destdir):
     taxid2assemblies, taxid2accessions = defaultdict(list), {}
-    for assembly_molecules in ThreadPoolExecutor().map(process_assembly_report, assembly_summaries):
-        if len(assembly_molecules) == 0:
-            continue  # draft assembly
-        taxid2assemblies[assembly_molecules[0]["taxid"]].append(assembly_molecules)
-        if assembly_molecules[0]["species_taxid"] != assembly_molecules[0]["taxid"]:
-            taxid2assemblies[assembly_molecules[0]["species_taxid"]].append(assembly_molecules)
+    with ThreadPoolExecutor(max_workers=max_http_workers) as executor:
+        assembly_reports = bounded_map(
+            executor, process_assembly_report, load_assembly_summaries(), max_pending=4 * max_http_workers
+        )
+        for assembly in assembly_reports:
+            assembly_summary, genbank_accns = assembly
+            if len(genbank_accns) == 0:
+                continue  # draft assembly
+            taxid2assemblies[assembly_summary["taxid"]].append(assembly)
+            if assembly_summary["species_taxid"] != assembly_summary["taxid"]:
+                taxid2assemblies[assembly_summary["species_taxid"]].append(assembly)
     for taxid, assemblies in taxid2assemblies.items():
-        best_assembly = sorted(assemblies, key=assembly_sort_key)[-1]
-        taxid2accessions[taxid] = ",".join(sorted([m["genbank_accn"] for m in best_assembly]))
+        _, genbank_accns = sorted(assemblies, key=assembly_sort_key)[-1]
+        taxid2accessions[taxid] = ",".join(sorted(genbank_accns))
     return taxid2accessions
 
 
@@ -531,12 +680,17 @@ def load_accession_info_from_blast_db(db_name):
             "-outfmt",
             "%a %o %l %T",
         ]
-        for line in subprocess.check_output(blastdbcmd).decode().splitlines():
-            accession_id, ordinal_id, length, tax_id = line.strip().split()
-            assert accession_id not in accessions_for_volume
-            accessions_for_volume[accession_id] = dict(
-                ordinal_id=int(ordinal_id), length=int(length), tax_id=int(tax_id)
-            )
+        # Parse the (large) listing line by line as it is produced instead of decoding it into one string first
+        with subprocess.Popen(blastdbcmd, stdout=subprocess.PIPE, bufsize=1024 * 1024) as proc:
+            for line in proc.stdout:
+                accession_id, ordinal_id, length, tax_id = line.split()
+                accession_id = accession_id.decode()
+                assert accession_id not in accessions_for_volume
+                accessions_for_volume[accession_id] = dict(
+                    ordinal_id=int(ordinal_id), length=int(length), tax_id=int(tax_id)
+                )
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, blastdbcmd)
 
         with open(f"{db_volume}.nin", "rb") as fh:
             # See ncbi-blast-2.9.0+-src/c++/src/objtools/blast/seqdb_reader/seqdbfile.cpp
@@ -550,8 +704,13 @@ def load_accession_info_from_blast_db(db_name):
             num_oids = struct.unpack(">I", fh.read(4))[0]
             volume_length = struct.unpack("<q", fh.read(8))[0]  # noqa: F841
             max_seq_length = struct.unpack(">I", fh.read(4))[0]  # noqa: F841
-            header_array = struct.unpack(f">{num_oids + 1}I", fh.read(4 * (num_oids + 1)))  # noqa: F841
-            sequence_array = struct.unpack(f">{num_oids + 1}I", fh.read(4 * (num_oids + 1)))
+            fh.seek(4 * (num_oids + 1), io.SEEK_CUR)  # Skip the header array
+            # Read the sequence offsets into a typed array rather than a tuple of num_oids + 1 Python ints
+            sequence_array = array.array("I")
+            assert sequence_array.itemsize == 4
+            sequence_array.fromfile(fh, num_oids + 1)
+            if sys.byteorder == "little":
+                sequence_array.byteswap()
             db_type = "Nucleotide" if sequence_type == 0 else "Protein"
             logger.info("%s database %s %s (%d records)", db_type, title, create_date, num_oids)
             for accession_id, accession_info in accessions_for_volume.items():
@@ -50,7 +50,8 @@ parser = argparse.ArgumentParser(prog="taxoniq", description=__doc__, formatter_
 parser.add_argument("--version", action="version", version=get_version())
 parser.add_argument(
     "operation",
-    choices=[attr.replace("_", "-") for attr in dir(Taxon) if not attr.startswith("_")]
+    # Slots hold per-instance data (such as the taxon ID itself) and are not operations
+    choices=[attr.replace("_", "-") for attr in dir(Taxon) if not attr.startswith("_") and attr not in Taxon.__slots__]
     + ["get-from-s3", "get-from-gs"],
 )
 parser.add_argument("--taxon-id", help="Numeric NCBI taxon ID")
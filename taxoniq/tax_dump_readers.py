@@ -2,22 +2,44 @@ import enum
 
 from . import Rank
 
+# Maps rank names as written in nodes.dmp (with spaces) to Rank values
+rank_values = {name.replace("_", " ").encode(): rank.value for name, rank in Rank.__members__.items()}
+
 
 class TaxDumpReader:
-    def __init__(self):
-        self.fh = open(self.table_name + ".dmp")
+    """
+    Iterates over the rows of a taxdump .dmp file as tuples of field values. If columns (a sequence of field names) is
+    given, only those fields are parsed, and each tuple holds them in that order; otherwise all fields are returned in
+    file order.
+    """
 
-    def __iter__(self):
-        def cast(field, value):
-            value = value.rstrip("\t|")
-            if field[0] == "rank":
-                return Rank[value.replace(" ", "_")].value
-            if field[1] == int and value == "":
-                return None
-            return field[1](value)
+    def __init__(self, columns=None):
+        # Rows are split as bytes, and only string columns are decoded
+        self.fh = open(self.table_name + ".dmp", "rb", buffering=1024 * 1024)
+        self.columns = columns
+
+    @staticmethod
+    def _get_caster(field):
+        if field[0] == "rank":
+            return rank_values.__getitem__
+        if field[1] == int:
+            return lambda value: int(value) if value else None
+        return bytes.decode
 
+    def __iter__(self):
+        if self.columns is None:
+            fields = list(enumerate(self.fields))
+        else:
+            field_indexes = {field[0]: i for i, field in enumerate(self.fields)}
+            fields = [(field_indexes[column], self.fields[field_indexes[column]]) for column in self.columns]
+        # The converter of each column is picked once, not per cell
+        casters = [(i, self._get_caster(field)) for i, field in fields]
+        n_fields = len(self.fields)
         for row in self.fh:
-            yield {self.fields[i][0]: cast(self.fields[i], value) for i, value in enumerate(row.strip().split("\t|\t"))}
+            values = row.strip().rstrip(b"\t|").split(b"\t|\t")
+            if len(values) < n_fields:
+                values.extend([b""] * (n_fields - len(values)))
+            yield tuple(cast(values[i]) for i, cast in casters)
 
 
 class NodesReader(TaxDumpReader):
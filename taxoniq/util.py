@@ -1,4 +1,11 @@
+import bisect
+import functools
 import io
+import mmap
+import os
+import struct
+
+import zstandard
 
 
 def byte_to_bases(x):
@@ -38,3 +45,28 @@ class NcbiNa2Decoder:
 class NcbistdaaDecoder:
     # See ncbi-blast-2.9.0+-src/c++/src/objtools/blast/seqdb_reader/sequence_files.txt
     pass
+
+
+class ZstdFrameIndex:
+    """
+    Random access to records in a file of independent zstd frames with a .zsti sidecar listing the uncompressed and
+    compressed start offset of each frame (see taxoniq.build.write_taxid_to_string_index). Records never span frames,
+    so reading one decompresses a single frame; recently used frames are cached.
+    """
+
+    def __init__(self, filename, frame_cache_size=64):
+        with open(filename, "rb") as fh:
+            self.data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(os.path.splitext(filename)[0] + ".zsti", "rb") as fh:
+            frame_index = fh.read()
+        frame_index = struct.unpack(f"<{len(frame_index) // 8}Q", frame_index)
+        self.frame_starts, self.frame_offsets = frame_index[0::2], frame_index[1::2] + (len(self.data),)
+        self.get_frame = functools.lru_cache(maxsize=frame_cache_size)(self._decompress_frame)
+
+    def _decompress_frame(self, frame_id):
+        return zstandard.decompress(self.data[self.frame_offsets[frame_id] : self.frame_offsets[frame_id + 1]])
+
+    def get_record(self, pos, length) -> memoryview:
+        frame_id = bisect.bisect_right(self.frame_starts, pos) - 1
+        start = pos - self.frame_starts[frame_id]
+        return memoryview(self.get_frame(frame_id))[start : start + length]
@@ -1,18 +1,22 @@
 #!/usr/bin/env python3
 
 import contextlib
+import copy
 import json
 import logging
 import os
+import pickle
 import sys
 import tempfile
 import unittest
+import unittest.mock
 from concurrent.futures import ThreadPoolExecutor
 from io import StringIO
 
 import taxoniq
 import taxoniq.build
 import taxoniq.cli
+import taxoniq.util
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -26,6 +30,7 @@ class TestTaxoniq(unittest.TestCase):
         )
         t2 = taxoniq.Taxon(accession_id="NC_000913.3")
         self.assertEqual(t2, taxoniq.Taxon(511145))
+        self.assertIs(t2, taxoniq.Taxon(511145))
         self.assertEqual(t2, taxoniq.Taxon(scientific_name="Escherichia coli str. K-12 substr. MG1655"))
         self.assertEqual(t2.scientific_name, "Escherichia coli str. K-12 substr. MG1655")
         self.assertEqual(t2.parent.parent.common_name, "E. coli")
@@ -43,6 +48,34 @@ class TestTaxoniq(unittest.TestCase):
             ],
         )
 
+    def test_identity(self):
+        self.assertEqual(len({taxoniq.Taxon(1), taxoniq.Taxon(1)}), 1)
+        names = {taxoniq.Taxon(511145): "E. coli K-12"}
+        self.assertEqual(names[taxoniq.Taxon(accession_id="NC_000913.3")], "E. coli K-12")
+        self.assertNotEqual(taxoniq.Taxon(1), taxoniq.Taxon(2))
+        self.assertNotEqual(taxoniq.Taxon(1), 1)
+        a, a2 = taxoniq.Accession("NC_000913.3"), taxoniq.Accession("NC_000913.3")
+        self.assertEqual(a, a2)
+        self.assertEqual(hash(a), hash(a2))
+        self.assertEqual(len({a, a2}), 1)
+        self.assertNotEqual(a, taxoniq.Accession("NC_052986.1"))
+        self.assertNotEqual(a, "NC_000913.3")
+        t = taxoniq.Taxon(511145)
+        self.assertIs(pickle.loads(pickle.dumps(t)), t)
+        # Pickle both an accession with loaded attributes and one without
+        self.assertEqual(a.tax_id, 511145)
+        for accession in a, a2:
+            unpickled = pickle.loads(pickle.dumps(accession))
+            self.assertEqual(unpickled, accession)
+            self.assertEqual(unpickled.tax_id, 511145)
+            self.assertEqual(unpickled.length, 4641652)
+        # Accessions that are not indexed can still be pickled and copied, since neither touches the databases
+        unknown = taxoniq.Accession("XX_000000.1")
+        for unknown_copy in pickle.loads(pickle.dumps(unknown)), copy.copy(unknown), copy.deepcopy(unknown):
+            self.assertEqual(unknown_copy, unknown)
+            with self.assertRaises(KeyError):
+                unknown_copy.tax_id
+
     def test_unset_attribute(self):
         self.assertEqual(taxoniq.Taxon(123).scientific_name, "Pirellula")
         with self.assertRaisesRegex(taxoniq.NoValue, "The taxon .* has no value indexed for"):
@@ -75,6 +108,9 @@ class TestTaxoniq(unittest.TestCase):
         a = taxoniq.Accession(accession_id="NC_000913.3")
         self.assertEqual(a.length, 4641652)
         self.assertEqual(a.tax_id, 511145)
+        self.assertEqual(taxoniq.Accession.batch_tax_ids(["NC_000913.3", "NC_000913.3"]), [511145, 511145])
+        with self.assertRaises(KeyError):
+            taxoniq.Accession.batch_tax_ids(["NC_000913.3", "XX_000000.1"])
         with a.get_from_s3() as fh:
             seq = fh.read()
             assert seq.startswith(
@@ -108,6 +144,7 @@ class TestTaxoniq(unittest.TestCase):
         a = taxoniq.Accession(accession_id="NZ_CP019573.1")
         self.assertEqual(a.length, 1745789)
         self.assertEqual(a.tax_id, 1817405)
+        self.assertEqual(taxoniq.Accession.batch_tax_ids(["NC_000001.11", "NZ_CP019573.1"]), [9606, 1817405])
 
     def test_refseq_index(self):
         t = taxoniq.Taxon(scientific_name="Mumps orthorubulavirus")
@@ -123,6 +160,21 @@ class TestTaxoniq(unittest.TestCase):
         for accession, seq in ThreadPoolExecutor().map(fetch_seq, taxon.refseq_representative_genome_accessions):
             assert accession.length == len(seq)
 
+    def test_string_index_round_trip(self):
+        records = {1: "root", 2: "Bacteria", 3: "Escherichia coli", 4: "Bacteria", 5: "", 6: "Sulfolobus solfataricus"}
+        records.update({tax_id: f"Ærøskøbing virus {tax_id}" for tax_id in range(10, 40)})
+        with tempfile.TemporaryDirectory() as destdir, unittest.mock.patch.object(
+            taxoniq.build, "string_db_frame_size", 40
+        ):
+            taxon_order = {str(tax_id): i for i, tax_id in enumerate(sorted(records, reverse=True))}
+            taxoniq.build.write_taxid_to_string_index(records.items(), "test", destdir, taxon_order=taxon_order)
+            string_db = taxoniq.util.ZstdFrameIndex(os.path.join(destdir, "test.zstd"))
+            self.assertGreater(len(string_db.frame_starts), 5)
+            string_pos = taxoniq.RecordTrie("II").mmap(os.path.join(destdir, "test.marisa"))
+            for tax_id, string_value in records.items():
+                pos, length = string_pos[str(tax_id)][0]
+                self.assertEqual(str(string_db.get_record(pos, length), "utf-8"), string_value)
+
     def test_wikipedia_client(self):
         client = taxoniq.build.WikipediaDescriptionClient()
         result_file = client.build_index(destdir="/tmp", max_records=2)
@@ -137,6 +189,8 @@ class TestTaxoniq(unittest.TestCase):
         with contextlib.redirect_stdout(buf):
             taxoniq.cli.cli(["ranked-lineage", "--accession-id", "NC_000913.3"])
         self.assertEqual(json.loads(buf.getvalue()), [562, 561, 543, 91347, 1236, 1224, 2])
+        with contextlib.redirect_stderr(StringIO()), self.assertRaises(SystemExit):
+            taxoniq.cli.cli(["tax-id", "--accession-id", "NC_000913.3"])
         in_buf = StringIO("NC_052986\nNC_055549\nNC_055159")
         tf = tempfile.NamedTemporaryFile(mode="wt")
         with contextlib.redirect_stdout(tf):